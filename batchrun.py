@@ -0,0 +1,196 @@
+'''
+Resumable batch processing of nexus scan files with results checkpointed to an on-disk store
+
+command line:
+    python batchrun.py store file1.nxs file2.nxs ...      run default task (features) on files, results in store
+    python batchrun.py store /data/visit/*.nxs -j 16      use 16 worker processes (default: all cpus)
+    python batchrun.py store /data/visit/*.nxs --retry    also retry scans that failed last time
+    python batchrun.py -h                                 all options
+or from python:
+    store = run(files, task, 'store_dir')                 task(filestr) -> picklable result (e.g. DataFrame)
+    store = run(files, task, 'store_dir', executor = ex)  any concurrent.futures style executor (submit/result)
+    store.results()                                       {scan number: result} for completed scans
+    store.failed()                                        {scan number: error message} for failed scans
+
+work is split by scan number (taken from the file name) and each scan's result is written to the store
+by the worker as soon as it is finished (via a temporary file, so never left incomplete); a re-run
+skips scans already in the store, so an interrupted batch continues where it stopped
+task must be a module-level function (so it can be pickled), e.g.
+    def reduce(filestr):
+        n = pdnx(filestr)
+        return pd.DataFrame({'eta': n.eta, 'roi': n.roi2_sum/n.ic1monitor})
+the store directory must be visible to all workers (e.g. shared file system for a cluster executor)
+'''
+
+import os
+import re
+import sys
+import glob
+import time
+import pickle
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from pdnx import pdnx
+
+
+def scan_number(filestr):
+    'scan number from file name, e.g. /dls/i16/data/2024/cm1234-1/729207.nxs -> 729207 (name without extension if no number)'
+    name = os.path.splitext(os.path.basename(filestr))[0]
+    numbers = re.findall(r'\d+', name)
+    return int(numbers[-1]) if numbers else name
+
+
+def _scan_order(scan):
+    'sort key for scan labels: scan numbers in numerical order, then other names'
+    return (isinstance(scan, str), scan)
+
+
+class resultstore():
+    '''
+    store = resultstore(directory)
+    directory of per-scan results: <scan>.pkl for completed scans, <scan>.err (error message) for failures
+    store.done(scan), store.load(scan), store.completed(), store.results(), store.failed(), store.to_frame()
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, scan, ext = '.pkl'):
+        return os.path.join(self.directory, str(scan) + ext)
+
+    def _write(self, filestr, data):
+        tmpfile = filestr + '.tmp%i' % os.getpid()
+        with open(tmpfile, 'wb') as f:
+            f.write(data)
+        os.replace(tmpfile, filestr)
+
+    def save(self, scan, result):
+        'save result for scan and remove any earlier error'
+        self._write(self.path(scan), pickle.dumps(result, protocol = pickle.HIGHEST_PROTOCOL))
+        if os.path.exists(self.path(scan, '.err')):
+            os.remove(self.path(scan, '.err'))
+
+    def save_error(self, scan, message):
+        self._write(self.path(scan, '.err'), message.encode())
+
+    def done(self, scan):
+        return os.path.exists(self.path(scan))
+
+    def load(self, scan):
+        with open(self.path(scan), 'rb') as f:
+            return pickle.load(f)
+
+    def _scans(self, ext):
+        scans = [os.path.basename(filestr)[:-len(ext)] for filestr in glob.glob(os.path.join(glob.escape(self.directory), '*' + ext))]
+        return sorted((int(scan) if scan.isdigit() else scan for scan in scans), key = _scan_order)
+
+    def completed(self):
+        'sorted list of completed scans'
+        return self._scans('.pkl')
+
+    def results(self):
+        '{scan: result} for all completed scans'
+        return {scan: self.load(scan) for scan in self.completed()}
+
+    def failed(self):
+        '{scan: error message} for scans that failed'
+        errors = {}
+        for scan in self._scans('.err'):
+            with open(self.path(scan, '.err')) as f:
+                errors[scan] = f.read()
+        return errors
+
+    def to_frame(self):
+        'completed DataFrame (or dict/Series) results concatenated with scan in the first index level'
+        results = self.results()
+        return pd.concat([pd.DataFrame(result) if isinstance(result, dict) else result for result in results.values()], keys = list(results)) if results else pd.DataFrame()
+
+    def __repr__(self):
+        return 'resultstore(%r): %i completed, %i failed' % (self.directory, len(self.completed()), len(self.failed()))
+
+
+def _run_task(task, filestr, scan, directory):
+    '''
+    worker: run task on filestr and checkpoint result (or error) for scan in store directory
+    returns (scan, file size in bytes, error message or None)
+    '''
+    store = resultstore(directory)
+    try:
+        store.save(scan, task(filestr))
+        return scan, os.path.getsize(filestr), None
+    except Exception as e:
+        store.save_error(scan, '%s: %s\n%s' % (filestr, e, traceback.format_exc()))
+        return scan, 0, '%s: %s' % (type(e).__name__, e)
+
+
+def features_task(filestr):
+    'default task: peak and edge summary table (quickfit.features) of all columns of scan'
+    import quickfit
+    return quickfit.features(pdnx(filestr))
+
+
+def run(files, task = features_task, store = 'batch_results', executor = None, processes = None, retry = False, force = False):
+    '''
+    store = run(files, task = features_task, store = 'batch_results', executor = None, processes = None, retry = False, force = False)
+    run task(filestr) for each file in parallel, saving each scan's result to store (resultstore or directory)
+    scans already in store are skipped (force = True to redo); failed scans are skipped unless retry = True
+    executor: object with concurrent.futures style submit() (e.g. ThreadPoolExecutor, dask/ipyparallel executors)
+        default: ProcessPoolExecutor with processes workers (default: number of cpus)
+    prints progress, throughput and failures; returns the resultstore
+    '''
+    if not isinstance(store, resultstore):
+        store = resultstore(store)
+    scans = {}
+    for filestr in files:
+        scans.setdefault(scan_number(filestr), filestr)     # first file for each scan number
+    failed = store.failed()
+    todo = [(scan, filestr) for scan, filestr in scans.items() if force or not (store.done(scan) or (scan in failed and not retry))]
+    print('=== %i scans: %i done, %i failed previously, %i to run' % (len(scans), len(store.completed()), len(failed), len(todo)))
+
+    pool = ProcessPoolExecutor(max_workers = processes) if executor is None else executor
+    nbytes = 0
+    nfailed = 0
+    t0 = time.time()
+    try:
+        futures = [pool.submit(_run_task, task, filestr, scan, store.directory) for scan, filestr in todo]
+        for i, future in enumerate(futures):
+            try:
+                scan, size, err = future.result()
+            except Exception as e:      # worker died or could not run task
+                scan, size, err = todo[i][0], 0, '%s: %s' % (type(e).__name__, e)
+                store.save_error(scan, '%s: %s' % (todo[i][1], err))
+            if err is None:
+                nbytes += size
+            else:
+                nfailed += 1
+                print('=== Failed: scan %s: %s' % (scan, err))
+            if (i + 1) % 100 == 0:
+                dt = max(time.time() - t0, 1e-9)
+                print('=== %i/%i scans, %.1f scans/s' % (i + 1, len(todo), (i + 1)/dt))
+    finally:
+        if executor is None:
+            pool.shutdown(cancel_futures = True)    # interrupted: completed scans are already in store
+    dt = max(time.time() - t0, 1e-9)
+    print('=== Processed %i scans (%i failed) in %.1f s: %.1f scans/s, %.1f MB/s' % (len(todo) - nfailed, nfailed, dt, len(todo)/dt, nbytes/1e6/dt))
+    return store
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Resumable batch processing of nexus scan files (default task: quickfit.features)')
+    parser.add_argument('store', help = 'result store directory (created if required)')
+    parser.add_argument('files', nargs = '+', help = 'nexus files')
+    parser.add_argument('-j', '--processes', type = int, default = None, help = 'number of worker processes (default: number of cpus)')
+    parser.add_argument('--retry', action = 'store_true', help = 'retry scans that failed previously')
+    parser.add_argument('--force', action = 'store_true', help = 'rerun all scans, even if already done')
+    args = parser.parse_args(argv)
+    store = run(args.files, features_task, args.store, processes = args.processes, retry = args.retry, force = args.force)
+    return 1 if store.failed() else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,48 @@
+'''
+Benchmark pdnx.resample against a python loop of np.interp for 1000 scans
+python bench_resample.py [nscans [npts [ngrid]]]
+'''
+
+import sys
+import time
+import numpy as np
+from pdnx import resample
+
+
+def make_scans(nscans, npts, seed = 0):
+    'repeated energy scans with slightly different ranges and lengths (ragged)'
+    rng = np.random.default_rng(seed)
+    scans = []
+    for i in range(nscans):
+        n = npts + rng.integers(-npts//10, npts//10 + 1)
+        x = np.linspace(8.06, 8.12, n) + rng.normal(0, 1e-4)
+        y = np.exp(-((x - 8.09)/0.005)**2) + rng.normal(0, 0.01, n)
+        scans += [(x, y)]
+    return scans
+
+
+def interp_loop(scans, grid):
+    result = np.full((len(scans), len(grid)), np.nan)
+    for i, (x, y) in enumerate(scans):
+        ok = (grid >= x[0]) & (grid <= x[-1])
+        result[i, ok] = np.interp(grid[ok], x, y)
+    return result
+
+
+def timeit(func, *args):
+    t0 = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - t0
+
+
+if __name__ == '__main__':
+    nscans, npts, ngrid = [int(arg) for arg in sys.argv[1:]] + [1000, 500, 1000][len(sys.argv) - 1:]
+    scans = make_scans(nscans, npts)
+    grid = np.linspace(8.06, 8.12, ngrid)
+    ref, t_loop = timeit(interp_loop, scans, grid)
+    lin, t_lin = timeit(resample, scans, None, None, grid)
+    binned, t_bin = timeit(resample, scans, None, None, grid, 'bin')
+    print('=== %i scans, ~%i points, %i grid points' % (nscans, npts, ngrid))
+    print('np.interp loop:      %8.1f ms' % (t_loop*1e3))
+    print('resample linear:     %8.1f ms   (max diff from loop %.2g)' % (t_lin*1e3, np.nanmax(np.abs(lin - ref))))
+    print('resample bin:        %8.1f ms' % (t_bin*1e3))
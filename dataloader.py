@@ -100,14 +100,23 @@ def vec2mat(vecx, vecy, vecz, n_inner=None):
 
 
 
-import scisoftpy
-from scisoftpy.dictutils import ListDict
+try:
+    import scisoftpy
+    from scisoftpy.dictutils import ListDict
+except:
+    print '=== scisoftpy not found - SRS .dat files use native reader (read_srs); tiff and nexus loaders need scisoftpy'
+    ListDict = dict
 
 
 
 
 import os.path
+import re
+import mmap
+import tempfile
+import copy
 import numpy as np
+from collections import OrderedDict
 try:
     import dlstools.specfilewrapper as specfilewrapper
 except:
@@ -119,6 +128,93 @@ from matplotlib.collections import PolyCollection
 import matplotlib.cm as cm
 #from matplotlib.colors import Normalize
 
+class srsdata(OrderedDict):
+    '''
+    SRS file contents from read_srs: ordered dictionary of data columns (NumPy arrays)
+    with header key-value pairs in .metadata (same layout as scisoftpy.io.load)
+    '''
+    pass
+
+def _srs_value(valstr):
+    'convert SRS header value string to int, float or unquoted string'
+    valstr = valstr.strip()
+    for typ in (int, float):
+        try:
+            return typ(valstr)
+        except:
+            pass
+    if len(valstr) > 1 and valstr[0] == valstr[-1] and valstr[0] in '\'"':
+        valstr = valstr[1:-1]
+    return valstr
+
+def read_srs(filename):
+    '''
+    read_srs(filename): native reader for SRS .dat files - returns srsdata object (see above)
+    header (up to &END) is searched in a memory map of the file (the table itself is read into memory);
+    key=value assignments (e.g. in <MetaDataAtStart> block) go to .metadata
+    numeric table is then parsed from the file in one vectorised NumPy call and accepted only if it has
+    a value for every column of every data line; otherwise (e.g. non-numeric columns such as file names)
+    the table is parsed column by column and non-numeric columns are kept as string arrays
+    '''
+    f = open(filename, 'rb')
+    try:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            iend = mm.find(b'&END')
+            if iend < 0:
+                raise ValueError('=== No &END found in SRS header of %s' % filename)
+            header = mm[:iend].decode('latin-1')
+            istart = mm.find(b'\n', iend) + 1        # first line after &END
+            while mm[istart:istart + 1] in (b'\n', b'\r'):
+                istart += 1                         # skip blank lines
+            iline = mm.find(b'\n', istart)
+            if iline < 0:
+                iline = len(mm)
+            labels = mm[istart:iline].decode('latin-1').split()
+            nrows = sum(1 for line in mm[iline + 1:].splitlines() if line.strip())
+        finally:
+            mm.close()
+
+        metadata = OrderedDict()
+        for line in header.splitlines():
+            line = line.strip()
+            if '=' in line and not line.startswith('&') and not line.startswith('<'):
+                key, val = line.split('=', 1)
+                metadata[key.strip()] = _srs_value(val)
+
+        f.seek(iline + 1)
+        try:
+            values = np.fromfile(f, sep=' ')      # whitespace in separator matches any whitespace
+            if len(labels) == 0 or len(values) != nrows*len(labels):
+                values = None                     # older numpy stops at non-numeric data without an error
+        except ValueError:                        # unmatched (non-numeric) data
+            values = None
+    finally:
+        f.close()
+
+    dat = srsdata()
+    dat.metadata = metadata
+    if values is None:                            # non-numeric fields - parse column by column
+        f = open(filename, 'rb')
+        f.seek(iline + 1)
+        rows = [line.decode('latin-1').split() for line in f if line.strip()]
+        f.close()
+        if any(len(row) != len(labels) for row in rows):    # e.g. last line of aborted scan
+            print '=== Warning: ignoring incomplete lines in SRS table of %s' % filename
+            rows = [row for row in rows if len(row) == len(labels)]
+        columns = list(zip(*rows)) if rows else [()]*len(labels)
+        for icol, label in enumerate(labels):
+            col = np.array(columns[icol])
+            try:
+                dat[label] = col.astype(float)
+            except ValueError:
+                dat[label] = col
+    else:
+        table = values.reshape(-1, len(labels))
+        for icol in range(len(labels)):
+            dat[labels[icol]] = table[:, icol]
+    return dat
+
 class quickplot:
     def plot_old(self, *args, **kwargs):
     	'''
@@ -225,24 +321,150 @@ class quickplot:
 	ax.ticklabel_format(useOffset=False)
         plt.title(plttitle, fontsize=11)
         plt.axis('tight')
-    def cards(self, xstr, ystr, zstr, cmap=cm.jet):
-        #experimental!
+    def cards(self, xstr, ystr, zstr, cmap=cm.jet, npts=None):
+        '''
+        3D waterfall of scan sequence (see sequence): one card (filled trace of zstr against ystr) per scan,
+        placed at the value of xstr for that scan
+        npts: decimate each trace to about npts points (keeps min and max in each bin, so peaks are not lost)
+        e.g. d.sequence(range(1000, 1300), ['psi', 'eta', 'APD']); d.cards('psi', 'eta', 'APD', npts=500)
+        scans with NaN values (e.g. missing from a disk-backed sequence) are left out
+        '''
         fig = plt.figure()
-        ax = fig.gca(projection='3d')
-        verts = []
-        zs = self.s.dict[xstr][:,0]
-        cols=cmap(np.linspace(0,1,len(zs)))
-        for jj in range(len(zs)):
-            verts.append(list(zip([self.s.dict[ystr][jj,0]]+list(self.s.dict[ystr][jj,:])+[self.s.dict[ystr][jj,-1]], [0]+list(self.s.dict[zstr][jj,:])+[0])))
-            #verts.append(list(zip(self.s.dict[ystr][jj,:], self.s.dict[zstr][jj,:])))
-        #poly = PolyCollection(verts, facecolors = [cm.hot(e) for e in 256.*np.array(range(len(zs)))/np.array(range(len(zs))).max()])
-        poly = PolyCollection(verts, facecolors = cols)
+        ax = fig.add_subplot(111, projection='3d')
+        ok = _finite_scans(self.s.dict[xstr], self.s.dict[ystr], self.s.dict[zstr])
+        zs = self.s.dict[xstr][ok,0]
+        cols=cmap(np.linspace(0,1,len(self.s.dict[xstr])))[ok]
+        poly = PolyCollection(_card_vertices(self.s.dict[ystr][ok], self.s.dict[zstr][ok], npts), facecolors = cols)
         poly.set_alpha(0.5)
         ax.add_collection3d(poly, zs=zs, zdir='y')
-        ax.set_xlim3d(self.s.dict[ystr].min(),self.s.dict[ystr].max())
-        ax.set_ylim3d(self.s.dict[xstr].min(),self.s.dict[xstr].max())
-        ax.set_zlim3d(self.s.dict[zstr].min(),self.s.dict[zstr].max())
-#        ax.set_zlim3d(0,self.s.dict[zstrd.sequence(mu2scans,'psi')
+        ax.set_xlim3d(self.s.dict[ystr][ok].min(),self.s.dict[ystr][ok].max())
+        ax.set_ylim3d(zs.min(),zs.max())
+        ax.set_zlim3d(self.s.dict[zstr][ok].min(),self.s.dict[zstr][ok].max())
+        ax.set_xlabel(ystr)
+        ax.set_ylabel(xstr)
+        ax.set_zlabel(zstr)
+
+    def image(self, xstr, ystr, zstr, cmap=cm.jet, **kwargs):
+        '''
+        2D image (pcolormesh) of scan sequence (see sequence): zstr against ystr (scan points) and xstr (one row per scan)
+        much faster than cards for long sequences; other keyword args are passed to pcolormesh, e.g. vmax, norm
+        e.g. d.sequence(range(1000, 1300), ['psi', 'eta', 'APD']); d.image('psi', 'eta', 'APD')
+        scans with NaN positions (e.g. missing from a disk-backed sequence) are left out, NaN values are blank
+        '''
+        ok = _finite_scans(self.s.dict[xstr], self.s.dict[ystr])
+        x, y = np.asarray(self.s.dict[ystr][ok], dtype=float), np.asarray(self.s.dict[xstr][ok], dtype=float)
+        plt.figure()
+        mesh = plt.pcolormesh(_cell_edges(_cell_edges(x, 1), 0), _cell_edges(_cell_edges(y, 1), 0),
+                              np.ma.masked_invalid(self.s.dict[zstr][ok]), cmap=cmap, **kwargs)
+        plt.colorbar(mesh, label=zstr)
+        plt.xlabel(ystr)
+        plt.ylabel(xstr)
+        plt.axis('tight')
+        return mesh
+
+def _finite_scans(*fields):
+    'indices of scans (rows) of sequence arrays with only finite values in all fields'
+    ok = np.ones(len(fields[0]), dtype=bool)
+    for field in fields:
+        ok &= np.isfinite(np.asarray(field, dtype=float)).reshape(len(ok), -1).all(1)
+    return np.nonzero(ok)[0]
+
+def _card_vertices(x, z, npts=None):
+    '''
+    polygon vertices for cards as (scans, points + 2, 2) array: each trace closed to zero at its first and last x
+    npts: decimate each trace to about npts points, keeping first, last and min and max z (in order) in each bin
+    '''
+    x, z = np.asarray(x, dtype=float), np.asarray(z, dtype=float)
+    nscans, n = z.shape
+    if npts is not None and n > npts > 3:
+        nbins = (npts - 2)//2
+        binsize = n//nbins
+        nfull = nbins*binsize
+        zbins = z[:, :nfull].reshape(nscans, nbins, binsize)
+        index = np.sort(np.stack([zbins.argmin(2), zbins.argmax(2)], 2), 2) + (np.arange(nbins)*binsize)[:, np.newaxis]
+        index = [np.zeros((nscans, 1), int), index.reshape(nscans, -1)]
+        if nfull < n:   #remaining points form a last (shorter) bin
+            index += [np.sort(np.stack([z[:, nfull:].argmin(1), z[:, nfull:].argmax(1)], 1), 1) + nfull]
+        index = np.concatenate(index + [np.full((nscans, 1), n-1)], 1)
+        x, z = np.take_along_axis(np.broadcast_to(x, z.shape), index, 1), np.take_along_axis(z, index, 1)
+    verts = np.zeros((nscans, z.shape[1] + 2, 2))
+    verts[:, 1:-1, 0] = x
+    verts[:, 0, 0] = x[:, 0]
+    verts[:, -1, 0] = x[:, -1]
+    verts[:, 1:-1, 1] = z
+    return verts
+
+def _cell_edges(a, axis):
+    'cell edges (mid-points, extrapolated at ends) of 2D array of cell centres along axis, for pcolormesh'
+    a = np.swapaxes(a, 0, axis)
+    if len(a) < 2:
+        edges = np.concatenate([a - 0.5, a + 0.5])
+    else:
+        mid = (a[1:] + a[:-1])/2
+        edges = np.concatenate([2*a[:1] - mid[:1], mid, 2*a[-1:] - mid[-1:]])
+    return np.swapaxes(edges, 0, axis)
+
+_record_names={}    #sanitised attribute names for each set of field names - computed once per set
+
+def _sanitised_names(keys):
+    '''
+    return dictionary of attribute name: field name for set of field names
+    attribute names have '-' and ' ' removed and '_' prepended if first character numeric
+    '''
+    keys=frozenset(keys)
+    if not keys in _record_names:
+        names={}
+        for key in keys:
+            newstr=str(key).replace('-','').replace(' ','')
+            if len(newstr)==0:
+                continue
+            if newstr[0].isdigit(): #prepend _ if first character numeric
+                newstr='_'+newstr
+            names[newstr]=key
+            if not newstr==str(key):
+                print '=== '+str(key)+' replaced by ' + newstr
+        _record_names[keys]=names
+    return _record_names[keys]
+
+class scanrecord(object):
+    '''
+    Read-only record of one scan, returned by calling a data loader: r=d(100)
+    fields are attributes (r.eta, names sanitised - see _sanitised_names) or items with original names (r['eta'])
+    other attributes and methods come from a shallow copy of the loader made when the scan was loaded, so they
+    refer to this scan even after later scans are loaded (r.plot('eta','APD'), r.datanumber, repr(r))
+    attributes are looked up when used - nothing is copied or compiled per field
+    '''
+    __slots__=('_dict', '_names', '_loader')
+    def __init__(self, dict, names, loader):
+        loader=copy.copy(loader)    #snapshot of loader state for this scan (references only)
+        loader.__dict__.pop('record', None)     #not previous record (would chain all records) - no field lookup
+        loader.dict=dict
+        object.__setattr__(self, '_dict', dict)
+        object.__setattr__(self, '_names', names)
+        object.__setattr__(self, '_loader', loader)
+    def _field(self, name):
+        try:
+            return self._dict[self._names[name]]
+        except KeyError:
+            raise AttributeError(name)
+    def __getattr__(self, name):
+        if name.startswith('__') or name in scanrecord.__slots__:
+            raise AttributeError(name)
+        if name in self._names:
+            return self._dict[self._names[name]]
+        return getattr(self._loader, name)
+    def __setattr__(self, name, value):
+        raise AttributeError('scanrecord is read-only')
+    def __getitem__(self, key):
+        return self._dict[key]
+    def __contains__(self, key):
+        return key in self._dict
+    def keys(self):
+        return self._dict.keys()
+    def __dir__(self):
+        return sorted(self._names)
+    def __repr__(self):
+        return repr(self._loader)
 
 class dataloader:
     '''
@@ -264,25 +486,23 @@ class dataloader:
     def get_preamble(self):
         return 'Base class - no preamble'
     def __call__(self, datanumber):
+        '''
+        load scan and return scanrecord with the scan fields as attributes
+        fields of the latest scan are also attributes of the loader (d(100); d.eta) if unpack is True
+        '''
         self.dict=self.load(int(datanumber))
-        if self.unpack:
-            self.unpackdict(self.dict)
         self.datanumber=int(datanumber)
-        return self
+        self.record=self.unpackdict(self.dict)
+        return self.record
     def unpackdict(self, dict):
-        #globals().update(self.dict)
-        for key in dict.keys():
-            try:
-                newstr=str(key).replace('-','').replace(' ','')
-                if newstr[0].isdigit(): #prepend _ if first character numeric
-                    newstr='_'+newstr
-                exec('self.'+newstr+'=dict["'+str(key)+'"]')
-                #print "=== Unpacking  "+str(key)+" now called "+newstr
-                if not newstr==str(key):
-                    print '=== '+str(key)+' replaced by ' + newstr
-            except:
-                pass
-             #   print "=== Warning: could not unpack "+str(key)
+        'return scanrecord for dictionary (replaces old method that created an attribute for each field)'
+        return scanrecord(dict, _sanitised_names(dict.keys()), self)
+    def __getattr__(self, name):
+        'only called for names that are not normal attributes - look up field in latest scanrecord'
+        record=self.__dict__.get('record')
+        if name.startswith('__') or record is None or not self.unpack:
+            raise AttributeError(name)
+        return record._field(name)
     def load(self,datanumber):
         self.open_source(self.source, self.sourcefunc)
         print '=== Using load from base class - does nothing'
@@ -373,11 +593,12 @@ class data:
 
 class ScanSequence:
     'Tools for handling data from a sequence of scans'
-    def sequence_to_dict(self, scanlist, fields=True):
+    def sequence_to_dict(self, scanlist, fields=True, scratch=None):
         '''
         reads data from scanlist, selects fields from field list 
         and creates disctionary of field values
         fields is a list of fields of a field name string that is contains other fields
+        scratch: directory for disk-backed arrays (see sequence)
         '''
         if fields:  #all fields - need to load a file and get all field names
             self(scanlist[0])
@@ -386,22 +607,74 @@ class ScanSequence:
                         
         self.s=data()
         self.s.dict={}       #create empty dictionary
+        self.s.scratch=None
+        self.s.scratchfiles=[]
+        if scratch is not None:
+            if not os.path.isdir(scratch):
+                os.makedirs(scratch)
+            self.s.scratch=tempfile.mkdtemp(prefix='sequence_', dir=scratch)  #new files for each sequence - earlier arrays may still be mapped
         
         for field in fields:
             self.s.dict[field]=[] #create empty list for each field           
-        for scan in scanlist:
-            self(scan)
-            for field in fields:
+        try:
+            for iscan, scan in enumerate(scanlist):
+                self(scan)
+                for field in fields:
+                    try:
+                        if scratch is not None and self._store_on_disk(field, iscan, len(scanlist)):
+                            continue
+                        self.s.dict[field]+=[self.dict[field]]
+#                        self.s.dict[field]+=[np.array(self.dict[field])] #try to fix bug
+                    except ValueError:
+                        print '=== Warning: %s in scan %i has different shape from previous scans - not stored' % (field, scan)
+                    except:
+                        print '=== Warning: Did not find %s in scan %i' % (field, scan)
+        finally:
+            if self.s.scratch is not None:
                 try:
-                    self.s.dict[field]+=[self.dict[field]]
-#                    self.s.dict[field]+=[np.array(self.dict[field])] #try to fix bug
-                except:
-                    print '=== Warning: Did not find %s in scan %i' % (field, scan)
+                    os.rmdir(self.s.scratch)    #empty if files were unlinked (see _store_on_disk)
+                except OSError:
+                    pass
+
+    def _store_on_disk(self, field, iscan, nscans):
+        '''
+        write numeric field from current scan into row iscan of disk-backed array (.npy memory map in scratch directory)
+        array is created on first use with one row per scan, filled with NaN so scans without the field (or with a
+        different shape) are not mistaken for zeros; returns False for non-numeric fields (kept in memory)
+        the file is unlinked as soon as it is mapped, so the disk space is freed when the array (and any views)
+        are dropped and nothing is left in scratch (where the OS allows it - otherwise the file is left)
+        '''
+        value=np.asarray(self.dict[field])
+        stored=self.s.dict[field]
+        if isinstance(stored, list):
+            if len(stored) > 0 or value.dtype.kind not in 'biufc':
+                return False
+            dtype=np.result_type(value.dtype, np.float64)   #so later float values are not truncated
+            filename=os.path.join(self.s.scratch, re.sub('[^A-Za-z0-9_]', '_', str(field))+'.npy')
+            while filename in self.s.scratchfiles:  #different fields with same sanitised name
+                filename=filename[:-4]+'_.npy'
+            self.s.scratchfiles+=[filename]
+            stored=np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=(nscans,)+value.shape)
+            try:
+                os.remove(filename)     #mapping stays valid (POSIX)
+            except OSError:
+                pass
+            stored[:]=np.nan
+            self.s.dict[field]=stored
+        if stored.shape[1:] != value.shape:
+            raise ValueError('Inconsistent shapes in scan sequence')
+        stored[iscan]=value
+        return True
 
     def reshape_dict(self):
         'reforms dictionary items (lists) to NumPy arrays'
         self.s.shapes={}
         for field in self.s.dict.keys():
+            if isinstance(self.s.dict[field], np.ndarray):  #disk-backed array with one row per scan
+                self.s.shapes[field]=list(self.s.dict[field].shape[1:]) or [1]
+                if self.s.shapes[field] != [1]:
+                    bigshape=self.s.shapes[field]
+                continue
             try:
                 self.s.shapes[field]=list(self.s.dict[field][0].shape)  #save shape of first list element as list
                 bigshape=list(self.s.dict[field][0].shape)              #keep track of shape of large object
@@ -411,7 +684,11 @@ class ScanSequence:
             try:
                 if not (self.s.shapes[field] == [1] or self.s.shapes[field] == bigshape):         #unexpected shape!
                     raise ValueError('Inconsistent shapes or data types in scan sequence')
-                if self.s.shapes[field] == [1]:
+                if isinstance(self.s.dict[field], np.ndarray):
+                    if self.s.shapes[field] == [1]:     #pad out scalars with a view - nothing read from disk
+                        col=self.s.dict[field].reshape([-1]+[1]*len(bigshape))
+                        self.s.dict[field]=np.broadcast_to(col, [len(col)]+bigshape)
+                elif self.s.shapes[field] == [1]:
                     self.s.dict[field]=np.outer(np.array(self.s.dict[field]),np.ones(bigshape)) #pad out scalars to make same size as arrays
                 else:
                     self.s.dict[field]=np.array(self.s.dict[field])
@@ -421,9 +698,18 @@ class ScanSequence:
         'Unpacks sequence disctionary to attributes of self.s'
         for field in self.s.dict.keys():
             setattr(self.s,field, self.s.dict[field])
-    def sequence(self, scanlist, fields=True):
-        'Loads scan sequence and unpacks pictionary'
-        self.sequence_to_dict(scanlist,fields)
+    def sequence(self, scanlist, fields=True, scratch=None):
+        '''
+        Loads scan sequence and unpacks pictionary
+        scratch: directory name - numeric fields are written to disk-backed arrays (.npy memory maps) as scans
+        are loaded, so sequences larger than memory can be used; slices are read from disk when accessed
+        each call uses a new subdirectory of scratch (d.s.scratch) and the files are removed once mapped, so the
+        space is freed when the arrays are no longer used; rows for scans without a field are NaN
+        (cards and image leave out scans with NaN values)
+        scalar fields are padded as read-only views - use np.array(d.s.field) for a writable copy
+        e.g. d.sequence(range(1000, 3000), ['psi', 'sum'], scratch='/scratch/psi_series')
+        '''
+        self.sequence_to_dict(scanlist,fields,scratch)
         self.reshape_dict()
         self.unpack_sequence()
 
@@ -489,7 +775,10 @@ class dlsloader(dataloader,ScanSequence, quickplot):
         #print self.file
         self.dirname=os.path.dirname(self.file)+os.sep #directory name with trailing separator - used for reading secondary data files etc
         #self.dataobject=scisoftpy.io.load(self.file, formats=['srs','tiff'],warn=not self.warn)
-        self.dataobject=scisoftpy.io.load(self.file, formats=['srs','tiff'],warn=self.warn) #change to warn = self.warn
+        if self.file.endswith('.dat'):
+            self.dataobject=read_srs(self.file)  #native SRS reader - no scisoftpy required
+        else:
+            self.dataobject=scisoftpy.io.load(self.file, formats=['srs','tiff'],warn=self.warn) #change to warn = self.warn
         labels=self.dataobject.keys()
         try:        
             scan=self.dataobject['scancommand']
@@ -0,0 +1,132 @@
+'''
+Convert a directory of NeXus scan files to Parquet (or Arrow IPC) tables using pdnx
+
+command line:
+    python nx2parquet.py indir outdir                 convert indir/*.nxs to outdir/*.parquet
+    python nx2parquet.py indir outdir -j 16           use 16 worker processes (default: all cpus)
+    python nx2parquet.py indir outdir -f arrow        write Arrow IPC (.arrow) files instead
+    python nx2parquet.py indir outdir --force         also convert files already converted and unchanged
+    python nx2parquet.py -h                           all options
+or from python:
+    convert_directory(indir, outdir, processes = 16)
+
+scan metadata (scan string, source file, entry and data paths) is stored as file (schema) metadata
+and nexus units as column (field) metadata
+files are skipped if the output exists and is newer than the nexus file
+'''
+
+import os
+import sys
+import glob
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.feather as feather
+
+from pdnx import pdnx, _entry, _measurement
+
+_extensions = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+
+def output_file(infile, outdir, format = 'parquet'):
+    'output file name for nexus file infile'
+    return os.path.join(outdir, os.path.splitext(os.path.basename(infile))[0] + _extensions[format])
+
+
+def is_converted(infile, outfile):
+    'True if outfile exists and is newer than infile'
+    return os.path.exists(outfile) and os.path.getmtime(outfile) >= os.path.getmtime(infile)
+
+
+def to_table(n):
+    'pyarrow table from pdnx object with scan metadata in schema and units in field metadata (scan is file name if no title)'
+    table = pa.Table.from_pandas(n, preserve_index = False)
+    fields = []
+    for field in table.schema:
+        try:
+            units = str(n.nx[n._entrydata][field.name].attrs['units'])
+            field = field.with_metadata({'units': units})
+        except:
+            pass
+        fields += [field]
+    metadata = {'scan': str(getattr(n, 'scan', n.nx.nxfilename)), 'source': str(n.nx.nxfilename), 'entry': str(n._entry), 'data': str(n._entrydata)}
+    return table.cast(pa.schema(fields, metadata = metadata))
+
+
+def convert_file(infile, outfile, format = 'parquet', entry = _entry, data = _measurement):
+    '''
+    convert nexus file infile to outfile (written via temporary file, so never left incomplete)
+    returns size of infile (bytes)
+    '''
+    n = pdnx(infile, entry = entry, data = data)
+    if not 'nx' in n.__dict__ or len(n.columns) == 0:   # pdnx prints error and returns uninitialised object on failure
+        raise ValueError('No scan data loaded from %s' % infile)
+    table = to_table(n)
+    tmpfile = outfile + '.tmp%i' % os.getpid()
+    if format == 'arrow':
+        feather.write_feather(table, tmpfile, compression = 'uncompressed')
+    else:
+        pq.write_table(table, tmpfile)
+    os.replace(tmpfile, outfile)
+    return os.path.getsize(infile)
+
+
+def _convert(args):
+    infile, outfile, format, entry, data = args
+    try:
+        return infile, convert_file(infile, outfile, format, entry, data), None
+    except Exception as e:
+        return infile, 0, str(e)
+
+
+def convert_directory(indir, outdir, format = 'parquet', processes = None, pattern = '*.nxs', force = False, entry = _entry, data = _measurement):
+    '''
+    convert all files matching pattern in indir using a pool of processes (default: number of cpus)
+    returns list of (file, error message) for files that failed
+    '''
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    infiles = sorted(glob.glob(os.path.join(indir, pattern)))
+    todo = []
+    for infile in infiles:
+        outfile = output_file(infile, outdir, format)
+        if force or not is_converted(infile, outfile):
+            todo += [(infile, outfile, format, entry, data)]
+    print('=== %i files found, %i already converted, %i to convert' % (len(infiles), len(infiles) - len(todo), len(todo)))
+
+    failed = []
+    nbytes = 0
+    t0 = time.time()
+    with ProcessPoolExecutor(max_workers = processes) as pool:
+        for infile, size, err in pool.map(_convert, todo, chunksize = 8):
+            if err is None:
+                nbytes += size
+            else:
+                failed += [(infile, err)]
+                print('=== Failed: %s: %s' % (infile, err))
+    dt = max(time.time() - t0, 1e-9)
+    nconverted = len(todo) - len(failed)
+    print('=== Converted %i files (%i failed) in %.1f s: %.1f files/s, %.1f MB/s' % (nconverted, len(failed), dt, nconverted/dt, nbytes/1e6/dt))
+    return failed
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Convert directory of NeXus scan files to Parquet/Arrow tables using pdnx')
+    parser.add_argument('indir', help = 'directory containing nexus files')
+    parser.add_argument('outdir', help = 'output directory (created if required)')
+    parser.add_argument('-f', '--format', choices = sorted(_extensions), default = 'parquet', help = 'output format (default parquet)')
+    parser.add_argument('-j', '--processes', type = int, default = None, help = 'number of worker processes (default: number of cpus)')
+    parser.add_argument('-p', '--pattern', default = '*.nxs', help = 'file name pattern (default *.nxs)')
+    parser.add_argument('--entry', default = _entry, help = 'nexus entry (default %s)' % _entry)
+    parser.add_argument('--data', default = _measurement, help = 'data field in entry (default %s)' % _measurement)
+    parser.add_argument('--force', action = 'store_true', help = 'convert files even if already converted and unchanged')
+    args = parser.parse_args(argv)
+    failed = convert_directory(args.indir, args.outdir, args.format, args.processes, args.pattern, args.force, args.entry, args.data)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
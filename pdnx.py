@@ -1,11 +1,22 @@
 # When NXclassic_scan in use: change to entry = None, data = None in pdnx.__init__
 
 import nexusformat.nexus as nx
+import h5py
 import pandas as pd
 import matplotlib
 import numpy as np
 import warnings
+import weakref
+import bisect
+import io
+import tokenize
+from multiprocessing import shared_memory, resource_tracker
+from concurrent.futures import ProcessPoolExecutor
 warnings.filterwarnings("ignore")
+try:
+    import numexpr
+except:
+    numexpr = None  # derived columns then use compiled python expressions with numpy
 
 pd.set_option('display.max_rows',8)
 pd.set_option('display.max_columns', 500)
@@ -15,6 +26,12 @@ pd.set_option('display.width',999)
 #scan_command_field_list = ['/entry1/scan_command']
 _entry = '/entry1'
 _measurement = '/measurement'
+_decimate_min_points = 20000    # pdnx.plt decimates line plots with more points than this
+_derived_columns = {}   # named derived column definitions: name -> expression (see define)
+_compiled_expressions = {}
+_numexpr_unsupported = set()
+_numexpr_expressions = {}  # (expression, column names) -> expression with columns renamed for numexpr
+_numpy_namespace = dict(vars(np), np = np)  # namespace for derived columns without numexpr, e.g. 'log(sum)' or 'np.log(sum)'
 
 
 class pdnx(pd.DataFrame): 
@@ -30,8 +47,19 @@ class pdnx(pd.DataFrame):
     n.plot()            plot pandas dataframe
     n.plot('idgap','ic1monitor')	pandas plot with selected x and y collumns
     n.plt('idgap','ic1monitor')		same but with pdnx defaults (title etc)	
+                                    long scans are min/max decimated to the axis width (re-evaluated on zoom)
+    resample(scans, 'DCMenergy', 'sum', grid)  2D array (scan, grid point) of many scans interpolated onto grid
+    decimate(x, y, 1000)            min/max decimation of x, y data (e.g. for exporting plots)
     n.nx                nexus tree
+    frames = load_parallel(files)       list of DataFrames loaded in parallel processes (columns via shared memory)
+    scans = loadentries(filestr)        dict of pdnx for every entry in multi-entry file (file opened once)
     print(n.nx.tree)     print nexus tree
+    n=pdnx(filestr, flatten = False)    keep shape of grid scans: MultiIndex DataFrame (n.to_xarray() for xarray)
+    n.grid('sum')       column as view with the scan shape, e.g. 2D array for grid scan
+    n.dataset('/entry1/instrument/pil/data')   dataset as memory map if contiguous and uncompressed (e.g. detector frames)
+    n.metadata()        pandas Series of scalar metadata values from positioners or before_scan group
+    metadata_table(files)   DataFrame of metadata values for many files (one row per file)
+    m = metastore(files)    metadata for many files stored as changes, e.g. m.series('kphi'), m.changed(file1, file2)
     n.find('chi')	find 'chi' key(s) in tree and display value(s) (n.find() for all)
     n.findkeys('chi')	return list of key value lists for key 'chi'
     n.pruned_tree(n)    return nexus tree up to n levels deep
@@ -42,22 +70,34 @@ class pdnx(pd.DataFrame):
     n.to_excel(filename)    save excel spreadsheet (standard Pandas method - see other .to_ methods)
     n.to_srs(filename)       save as SRS .dat file (requires NXclassic_scan)
     n.to_srs_plus(filename)    save as SRS .dat file with key-value metadata assignments (requires NXclassic_scan)
+    define('norm', 'sum/ic1monitor')    define reusable named derived column
+    n.derive('norm')    add derived column 'norm' to dataframe (also n.derive('sum/ic1monitor', 'norm'))
+    derive(pd.concat(scans), 'norm')    same for any DataFrame, e.g. many scans concatenated
 
     '''
 
 
-    def __init__(self,  filestr, entry = _entry, data = _measurement, round = True):
+    def __init__(self,  filestr, entry = _entry, data = _measurement, round = True, mmap = True, flatten = True):
         '''
+        filestr = file name or nexus tree already loaded with nxload
         entry = select nexus entry for measurement data and set default to this entry
         data = nexus field containing datafor pandas dataframe
+        data = None: use entry if it has NXclassic_scan definition, otherwise first NXclassic_scan entry or subentry found
         round: Attempt to round data using @range attributes if they exist
+        mmap: use copy-on-write memory maps of the file for contiguous, uncompressed datasets (not copied into memory)
+        flatten = False: keep shape of grid/nested scans - MultiIndex with one level (dim0, dim1...) per scan dimension
+            columns are views of the original data and fields with other shapes are left out
         '''
-        try:
-            _nx = nx.nxload(filestr,'r')
+        if isinstance(filestr, nx.NXroot):   # already loaded nexus tree (e.g. from loadentries)
+            _nx = filestr
+            filestr = _nx.nxfilename
+        else:
+            try:
+                _nx = nx.nxload(filestr,'r')
 
-        except:
-            print("=== Error loading file %s" % filestr)
-            return
+            except:
+                print("=== Error loading file %s" % filestr)
+                return
         
         _load_dataframe_success = False
         _use_classicscan = False
@@ -67,7 +107,8 @@ class pdnx(pd.DataFrame):
             entrydata = entry+data
         else:
             try:
-                entry =  getNexusSubentryWithDefinition(_nx, definition = 'NXclassic_scan')
+                if entry == None or not _has_definition(_nx, entry, 'NXclassic_scan'):    # e.g. default entry: search file
+                    entry =  getNexusSubentryWithDefinition(_nx, definition = 'NXclassic_scan')
                 for key in _nx[entry].keys():
                     if 'NXdata' in str(type(_nx[entry][key])):
                         entrydata = '%s/%s' % (entry, key)
@@ -91,9 +132,33 @@ class pdnx(pd.DataFrame):
 
             nx_scan_dict = {}
 
+            _h5 = None
+            if mmap:
+                try:
+                    _h5 = h5py.File(_nx.nxfilename, 'r')
+                except:
+                    pass
+
+            _fields = {}
             for key in keys:
                 try:
-                    nx_scan_dict[key] = _nx[entrydata][key].nxdata.flatten()
+                    values = None
+                    if _h5 is not None:
+                        values = _memmap_dataset(_h5[_nx[entrydata][key].nxpath])
+                    if values is None:
+                        _fields[key] = (_nx[entrydata][key].nxdata, not flatten)
+                    else:
+                        _fields[key] = (values, True)       # view of memory map
+                except:
+                    pass
+            _scan_shape = _get_scan_shape(_nx, entry, [np.shape(values) for values, _view in _fields.values()])
+
+            for key in _fields:
+                try:
+                    values, _view = _fields[key]
+                    if not flatten and np.shape(values) != _scan_shape:
+                        continue                    # e.g. detector data with extra dimensions
+                    nx_scan_dict[key] = values.reshape(-1) if _view else values.flatten()
                     if round == True:
                         try: # try to round
                             decimals = _nx[entrydata][key].attrs['decimals']
@@ -104,7 +169,13 @@ class pdnx(pd.DataFrame):
                             pass
                 except:
                     pass
-            pd.DataFrame.__init__(self, nx_scan_dict, columns = keys)
+            if _h5 is not None:
+                _h5.close()
+            if flatten or len(_scan_shape) < 2:
+                pd.DataFrame.__init__(self, nx_scan_dict, columns = keys, copy = False)
+            else:   # one index level per scan dimension
+                index = pd.MultiIndex.from_product([range(npts) for npts in _scan_shape], names = ['dim%i' % i for i in range(len(_scan_shape))])
+                pd.DataFrame.__init__(self, nx_scan_dict, columns = [key for key in keys if key in nx_scan_dict], index = index, copy = False)
     
             _load_dataframe_success = True
         except:
@@ -126,6 +197,10 @@ class pdnx(pd.DataFrame):
         except:
             pass
 
+        try:
+            self._scan_shape = tuple(_scan_shape)
+        except:
+            self._scan_shape = (len(self),)
         self._use_classicscan = _use_classicscan
         self._entrydata = entrydata
         self._entry = entry
@@ -155,9 +230,7 @@ class pdnx(pd.DataFrame):
         #prototype looks for named field (scan) - need to modify to find field containing classic_scan definition
         if not self._use_classicscan:
             raise ValueError('=== The to_srs_plus method requires a NeXus file with NXclassic_scan definition. \nYou might still be able to use .to_csv')
-        #positioner_tree_list  =  self.nx.entry1.scan.positioners.tree.split('\n')
-        positioner_tree_list  =  self.nx[self._entry].positioners.tree.split('\n')
-        assignments_list  =  [assig.lstrip() for assig in positioner_tree_list if '=' in assig and not '@'in assig]
+        assignments_list  =  [_srs_assignment(name, value) for name, value in _nxleaves(self.nx[self._entry].positioners)]
         try:
             #scan_command_assignment = ["scan_command = '%s'" % str(self.nx.entry1.scan.scan_command)]
             scan_command_assignment = ["scan_command = '%s'" % str(self.nx[self._entry].scan_command)]
@@ -167,11 +240,125 @@ class pdnx(pd.DataFrame):
         self.to_srs(outfile, assignments_list)
 
 
+    def grid(self, key):
+        '''
+        Return column as array with the original scan shape (e.g. 2D for grid scan) - a view, not a copy
+        n.grid('sum')[3] is then the fourth inner scan
+        '''
+        return self[key].values.reshape(self._scan_shape)
+
+
+    def dataset(self, path):
+        '''
+        Return dataset at nexus path (e.g. detector frames) as memory map if it is stored
+        contiguous and uncompressed, otherwise as array read via nexusformat
+        '''
+        with h5py.File(self.nx.nxfilename, 'r') as h5file:
+            values = _memmap_dataset(h5file[path])
+        if values is None:
+            values = self.nx[path].nxdata
+        return values
+
+
+    def metadata(self, group = None):
+        '''
+        Return pandas Series of scalar metadata values (e.g. motor positions) from group in the scan entry
+        group = None: use positioners (NXclassic_scan) if it exists, otherwise before_scan
+        '''
+        if group == None:
+            group = 'positioners' if 'positioners' in self.nx[self._entry] else 'before_scan'
+        return nxmetadata(self.nx[self._entry][group])
+
+
+    def derive(self, expr, name = None):
+        'Add column calculated from expression or named definition (see derive function)'
+        return derive(self, expr, name)
+
+
     def plt(self, *args, **kwargs):
+        '''
+        pandas plot with pdnx defaults (title etc)
+        line plots of long scans (see _decimate_min_points) are min/max decimated to the axis
+        pixel width and re-decimated when zooming - use decimate = False for a full plot
+        (full pandas plot is also used for keyword args that the decimated plot does not support)
+        '''
         _title_length = 90
         kwargs.setdefault('title', self.scan[:_title_length])
         kwargs.setdefault('grid', True)
-        self.plot(*args, **kwargs)
+        if not kwargs.pop('decimate', True) or len(self) <= _decimate_min_points or len(args) > 2 \
+                or kwargs.get('kind', 'line') != 'line' or not _decimated_plot_kwargs(kwargs):
+            self.plot(*args, **kwargs)
+            return
+        self._plt_decimated(*args, **kwargs)
+
+
+    def _plt_decimated(self, x = None, y = None, **kwargs):
+        from matplotlib import pyplot
+        x = kwargs.pop('x', x)
+        y = kwargs.pop('y', y)
+        kwargs.pop('kind', None)
+        if x == None:
+            xdata, xlabel = self.index.values, self.index.name
+        else:
+            xdata, xlabel = self[x].values, x
+        if y == None:
+            y = [col for col in self.columns if col != x and np.issubdtype(self[col].dtype, np.number)]
+        elif isinstance(y, str):
+            y = [y]
+        ax = kwargs.pop('ax', None)
+        if ax == None:
+            ax = pyplot.figure(figsize = kwargs.pop('figsize', None)).gca()
+        kwargs.pop('figsize', None)
+        title, grid, legend = kwargs.pop('title'), kwargs.pop('grid'), kwargs.pop('legend', True)
+        xlabel, ylabel = kwargs.pop('xlabel', xlabel), kwargs.pop('ylabel', None)
+        xlim, ylim, rot, fontsize = kwargs.pop('xlim', None), kwargs.pop('ylim', None), kwargs.pop('rot', None), kwargs.pop('fontsize', None)
+        loglog = kwargs.pop('loglog', False)
+        logx, logy = kwargs.pop('logx', False) or loglog, kwargs.pop('logy', False) or loglog
+        style = kwargs.pop('style', None)
+        if isinstance(style, dict):
+            styles = [style.get(col) for col in y]
+        elif isinstance(style, (list, tuple)):
+            styles = list(style)
+        else:
+            styles = [style]*len(y)
+        nbins = int(ax.bbox.width)
+
+        lines = []
+        for col, fmt in zip(y, styles):
+            ydata = self[col].values
+            args = decimate(xdata, ydata, nbins) + ((fmt,) if fmt else ())
+            line, = ax.plot(*args, label = col, **kwargs)
+            lines += [(line, ydata)]
+
+        def _redecimate(ax):
+            xL, xU = sorted(ax.get_xlim())
+            iI = (xdata >= xL) & (xdata <= xU)
+            for line, ydata in lines:
+                line.set_data(*decimate(xdata[iI], ydata[iI], int(ax.bbox.width)))
+            ax.figure.canvas.draw_idle()
+
+        if logx:
+            ax.set_xscale('symlog' if logx == 'sym' else 'log')
+        if logy:
+            ax.set_yscale('symlog' if logy == 'sym' else 'log')
+        ax.callbacks.connect('xlim_changed', _redecimate)
+        if xlim != None:
+            ax.set_xlim(xlim)
+        if ylim != None:
+            ax.set_ylim(ylim)
+        ax.set_title(title)
+        ax.grid(grid)
+        if xlabel != None:
+            ax.set_xlabel(xlabel)
+        if ylabel != None:
+            ax.set_ylabel(ylabel)
+        if rot != None:
+            ax.tick_params(axis = 'x', labelrotation = rot)
+        if fontsize != None:
+            ax.tick_params(labelsize = fontsize)
+        if legend and len(y) > 0:
+            ax.legend()
+        return ax
 
 
     def _list_to_dot_sep_string(self, lst):
@@ -253,6 +440,560 @@ def getNexusSubentryWithDefinition(nxroot, definition = None):
     return field_with_definition
 
 
+def _has_definition(nxroot, entry, definition):
+    'True if entry (path string) in nexus tree has the specified definition'
+    try:
+        return str(nxroot[entry]['definition']) == definition
+    except:
+        return False
+
+
+def getNexusSubentriesWithDefinition(nxroot, definition):
+    '''
+    return list of NeXus tree branch strings for all entries and subentries containing the specified definition (string)
+    '''
+    fields_with_definition = []
+    for entry in nxroot.keys():
+        try:
+            if str(nxroot[entry]['definition']) == definition:
+                fields_with_definition += ['/%s' % entry]
+                continue
+        except:
+            pass
+        try:
+            for subentry in nxroot[entry].keys():
+                if 'NXsubentry' in str(type(nxroot[entry][subentry])):
+                    try:
+                        if str(nxroot[entry][subentry]['definition']) == definition:
+                            fields_with_definition += ['/%s/%s' % (entry, subentry)]
+                    except:
+                        pass
+        except:
+            pass
+    return fields_with_definition
+
+
+def loadentries(filestr, data = _measurement, round = True, concat = False):
+    '''
+    load scan data from every entry of a multi-entry nexus file - the file is opened and parsed once
+    and the tree is shared by all the pdnx objects
+    data = nexus field containing data in each entry (see pdnx)
+    data = None: load every entry/subentry with NXclassic_scan definition
+    returns dict of pdnx objects keyed by entry (or entry/subentry) path
+    concat = True: return single DataFrame with (entry, point) MultiIndex
+    '''
+    _nx = nx.nxload(filestr,'r')
+    if data == None:
+        entries = getNexusSubentriesWithDefinition(_nx, 'NXclassic_scan')
+    else:
+        entries = []
+        for key in _nx.keys():
+            try:
+                _nx['/%s%s' % (key, data)]
+                entries += ['/%s' % key]
+            except:
+                pass
+    scans = {}
+    for entry in entries:
+        scans[entry] = pdnx(_nx, entry = entry, data = data, round = round)
+    if concat:
+        return pd.concat(scans, names = ['entry', None])
+    return scans
+
+
+_decimated_plot_options = ('x', 'y', 'kind', 'ax', 'figsize', 'title', 'grid', 'legend', 'xlabel', 'ylabel', 'xlim', 'ylim',
+                           'rot', 'fontsize', 'logx', 'logy', 'loglog', 'style')
+
+
+def _decimated_plot_kwargs(kwargs):
+    'True if all plot keyword args are pandas options handled by pdnx._plt_decimated or valid Line2D properties'
+    from matplotlib.lines import Line2D
+    for key, value in kwargs.items():
+        if key in _decimated_plot_options:
+            continue
+        try:
+            Line2D([], []).set(**{key: value})
+        except:
+            return False
+    return True
+
+
+def _get_scan_shape(nxroot, entry, shapes):
+    '''
+    shape of scan: from scan_dimensions in entry (or its parent entry) if a field has that shape,
+    otherwise the most common of the lowest-rank field shapes (detector fields have extra dimensions)
+    '''
+    for path in [entry, entry.rsplit('/', 1)[0]] if entry else []:
+        try:
+            shape = tuple(int(npts) for npts in np.atleast_1d(nxroot[path]['scan_dimensions'].nxdata))
+            if shape in shapes:
+                return shape
+        except:
+            pass
+    shapes = [shape for shape in shapes if len(shape) > 0]
+    if not shapes:
+        return None
+    rank = min(len(shape) for shape in shapes)
+    shapes = [shape for shape in shapes if len(shape) == rank]
+    return max(shapes, key = shapes.count)
+
+
+def _memmap_dataset(dataset):
+    '''
+    return copy-on-write np.memmap of numeric h5py dataset at its offset in the file if it is stored contiguous
+    (not chunked, so no compression filters) and allocated, otherwise None
+    '''
+    try:
+        if dataset.chunks is not None or dataset.external is not None or dataset.is_virtual or dataset.dtype.kind not in 'biufc':
+            return None
+        offset = dataset.id.get_offset()
+        if offset is None or dataset.size == 0:
+            return None
+        return np.memmap(dataset.file.filename, dtype = dataset.dtype, mode = 'c', offset = offset, shape = dataset.shape)
+    except:
+        return None
+
+
+def _scalar(value):
+    'return python scalar from nexus/hdf5 field value (bytes decoded) or None for arrays'
+    if isinstance(value, np.ndarray):
+        if value.size != 1:
+            return None
+        value = value.item()
+    elif isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, bytes):
+        value = value.decode()
+    return value
+
+
+def _nxleaves(group):
+    'generator of (name, value) for scalar fields in nexus group and its subgroups (values as python types)'
+    for key in group.keys():
+        item = group[key]
+        if isinstance(item, nx.NXgroup):
+            for leaf in _nxleaves(item):
+                yield leaf
+        elif isinstance(item, nx.NXfield):
+            try:
+                value = _scalar(item.nxdata)
+                if value is not None:   # skip arrays
+                    yield key, value
+            except:
+                pass
+
+
+def _h5leaves(h5group, _visited = None):
+    '''
+    as _nxleaves but for h5py group - reads only the fields in the group, not the whole tree
+    soft/external links are followed (e.g. positioners linking to before_scan fields); each group is read once
+    '''
+    _visited = set() if _visited is None else _visited
+    _visited.add(h5group.id)
+    leaves = []
+    for key in h5group.keys():
+        try:
+            obj = h5group[key]      # resolves links
+        except (KeyError, OSError):
+            continue                # dangling link
+        if isinstance(obj, h5py.Group):
+            if obj.id not in _visited:    # same object reached by another link
+                leaves += _h5leaves(obj, _visited)
+        elif isinstance(obj, h5py.Dataset) and obj.size == 1:
+            leaves.append((key, _scalar(obj[()])))
+    return leaves
+
+
+def _srs_assignment(name, value):
+    'SRS header assignment string for metadata value'
+    if isinstance(value, str):
+        return "%s = '%s'" % (name, value)
+    return '%s = %s' % (name, value)
+
+
+def nxmetadata(group):
+    '''
+    Return pandas Series of scalar values from nexus group (e.g. before_scan or positioners) and its subgroups
+    keyed by field name (first occurrence is used if a name is repeated in different subgroups)
+    '''
+    values = {}
+    for name, value in _nxleaves(group):
+        values.setdefault(name, value)
+    return pd.Series(values, dtype = object)
+
+
+def _read_metadata(filestr, group = 'before_scan', entry = _entry):
+    'dict of scalar metadata values from group in entry of file (first occurrence is used if a name is repeated)'
+    values = {}
+    with h5py.File(filestr, 'r') as h5file:
+        for name, value in _h5leaves(h5file[entry + '/' + group]):
+            values.setdefault(name, value)
+    return values
+
+
+def metadata_table(files, group = 'before_scan', entry = _entry):
+    '''
+    Return DataFrame of scalar metadata values from group in entry (one row per file, indexed by file)
+    e.g. metadata_table([p % i for i in range(633777, 633800)])['kphi']
+    Files that can't be read give a row of NaN
+    see also metastore for many scans (stores only the values that change)
+    '''
+    rows = {}
+    for filestr in files:
+        try:
+            rows[filestr] = _read_metadata(filestr, group, entry)
+        except:
+            print('=== Problem reading metadata from %s' % filestr)
+            rows[filestr] = {}
+    return pd.DataFrame.from_dict(rows, orient = 'index').reindex(list(rows)).infer_objects()
+
+
+def _same(a, b):
+    'metadata values equal (NaN equals NaN)'
+    return a == b or (a != a and b != b)
+
+
+class metastore():
+    '''
+    delta-encoded metadata for many scans: values for the first scan (baseline) and then only the values that change
+    store = metastore(files, group = 'before_scan')     read scalar metadata from files (h5py), labelled by file
+    store = metastore(files, labels = scannumbers)      label scans by e.g. scan number instead
+    store = metastore.from_frame(metadata_table(files)) from dense table (one row per scan)
+    store.add(scan, values)     add dict of values for next scan, e.g. store.add(633777, n.metadata())
+    store.value('kphi', scan)   value at scan (None if not recorded for scan)
+    store.series('kphi', a, b)  pandas Series of values for scans a to b inclusive (default all)
+    store.changed(a, b)         {name: (value at a, value at b)} for values that differ between scans a and b
+    store.changes(scan)         {name: value} for values that changed at scan (all values for first scan)
+    store.baseline              {name: value} for first scan
+    store.to_frame()            dense DataFrame like metadata_table
+    a value missing from a scan is recorded as a change to None
+    '''
+    def __init__(self, files = (), group = 'before_scan', entry = _entry, labels = None):
+        self.scans = []         # scan labels in order
+        self._position = {}     # label: position in scans
+        self._deltas = []       # {name: value} changed at each scan
+        self._index = {}        # name: ([positions of changes], [values])
+        self._current = {}
+        for filestr, label in zip(files, files if labels is None else labels):
+            try:
+                values = _read_metadata(filestr, group, entry)
+            except:
+                print('=== Problem reading metadata from %s' % filestr)
+                values = {}
+            self.add(label, values)
+
+    @classmethod
+    def from_frame(cls, frame):
+        'metastore from DataFrame with one row of values per scan (NaN for missing), e.g. from metadata_table'
+        store = cls()
+        for label, row in zip(frame.index, frame.to_dict('records')):
+            store.add(label, {name: value for name, value in row.items() if not (isinstance(value, float) and np.isnan(value))})
+        return store
+
+    def add(self, scan, values):
+        'add dict (or Series) of metadata values for next scan, labelled scan'
+        if scan in self._position:
+            raise ValueError('Scan %s is already in metastore' % (scan,))
+        pos = len(self.scans)
+        delta = {}
+        for name, value in values.items():
+            if name not in self._current or not _same(self._current[name], value):
+                delta[name] = value
+        for name in self._current:
+            if name not in values and self._current[name] is not None:
+                delta[name] = None
+        for name, value in delta.items():
+            positions, changes = self._index.setdefault(name, ([], []))
+            positions.append(pos)
+            changes.append(value)
+            self._current[name] = value
+        self.scans.append(scan)
+        self._position[scan] = pos
+        self._deltas.append(delta)
+
+    def _pos(self, scan):
+        try:
+            return self._position[scan]
+        except KeyError:
+            raise KeyError('Scan %s is not in metastore' % (scan,))
+
+    def _value(self, name, pos):
+        positions, changes = self._index[name]
+        i = bisect.bisect_right(positions, pos) - 1
+        return changes[i] if i >= 0 else None
+
+    def value(self, name, scan):
+        'value of name at scan (None if not recorded)'
+        return self._value(name, self._pos(scan))
+
+    def series(self, name, a = None, b = None):
+        'pandas Series of values of name for scans a to b inclusive (default: first and last scan)'
+        ia = 0 if a is None else self._pos(a)
+        ib = len(self.scans) - 1 if b is None else self._pos(b)
+        positions, changes = self._index[name]
+        i = np.searchsorted(positions, np.arange(ia, ib + 1), side = 'right')
+        values = np.array([None] + changes, dtype = object)[i]
+        return pd.Series(values, index = self.scans[ia:ib + 1], name = name).infer_objects()
+
+    def changed(self, a, b):
+        '{name: (value at a, value at b)} for names with different values at scans a and b'
+        ia, ib = sorted([self._pos(a), self._pos(b)])
+        result = {}
+        for name, (positions, changes) in self._index.items():
+            if bisect.bisect_right(positions, ib) > bisect.bisect_right(positions, ia):    # changed in between
+                va, vb = self._value(name, self._pos(a)), self._value(name, self._pos(b))
+                if not _same(va, vb):   # not moved back
+                    result[name] = (va, vb)
+        return result
+
+    def changes(self, scan):
+        '{name: value} for values changed at scan (all values for first scan)'
+        return dict(self._deltas[self._pos(scan)])
+
+    @property
+    def baseline(self):
+        return dict(self._deltas[0]) if self._deltas else {}
+
+    def names(self):
+        return list(self._index)
+
+    def to_frame(self, names = None):
+        'dense DataFrame of values (one row per scan) for names (default all)'
+        return pd.DataFrame({name: self.series(name) for name in (self.names() if names is None else names)}, index = self.scans)
+
+    def __len__(self):
+        return len(self.scans)
+
+    def __repr__(self):
+        nstored = sum(len(delta) for delta in self._deltas)
+        return 'metastore: %i scans, %i names, %i values stored (%i dense)' % (len(self.scans), len(self._index), nstored, len(self.scans)*len(self._index))
+
+
+def _load_shared(filestr, shared, kwargs):
+    '''
+    worker for load_parallel: load pdnx and put numeric columns in shared memory segments
+    returns (scan string, list of (column, data or (segment name, dtype, length)))
+    '''
+    n = pdnx(filestr, **kwargs)
+    if not 'nx' in n.__dict__:
+        raise ValueError('Problem loading %s' % filestr)
+    columns = []
+    for key in n.columns:
+        values = n[key].values
+        if shared and values.dtype.kind in 'biufc' and values.nbytes > 0:
+            shm = shared_memory.SharedMemory(create = True, size = values.nbytes)
+            np.ndarray(values.shape, dtype = values.dtype, buffer = shm.buf)[:] = values
+            columns += [(key, (shm.name, values.dtype.str, len(values)))]
+            shm.close()     # segment is unlinked by parent
+        else:
+            columns += [(key, values)]  # pickled
+    return getattr(n, 'scan', filestr), columns
+
+
+def _attach_shared(name, dtype, length):
+    '''
+    return array using shared memory segment without copying - segment name is removed at once and the memory
+    is freed when the array (and any views of it) is garbage collected
+    '''
+    shm = shared_memory.SharedMemory(name = name)
+    shm.unlink()
+    values = np.ndarray((length,), dtype = np.dtype(dtype), buffer = shm.buf)
+    weakref.finalize(values, shm.close)   # unmap when array is dropped (views keep array alive)
+    return values
+
+
+def load_parallel(files, processes = None, shared = True, **kwargs):
+    '''
+    load many files with pdnx using a pool of processes (default: number of cpus)
+    returns list of DataFrames (scan string in .attrs['scan']; None for files that failed)
+    shared = True: numeric columns are returned through shared memory rather than pickled, and the DataFrames
+        use the shared buffers directly (no copy); the memory is freed when the DataFrame is dropped
+    other keyword arguments are passed to pdnx, e.g. load_parallel(files, entry = '/entry1', data = '/measurement')
+    '''
+    if shared:
+        resource_tracker.ensure_running()   # workers share the parent's tracker, so segments are not removed at worker exit
+    frames = []
+    with ProcessPoolExecutor(max_workers = processes) as pool:
+        futures = [pool.submit(_load_shared, filestr, shared, kwargs) for filestr in files]
+        for filestr, future in zip(files, futures):
+            try:
+                scan, columns = future.result()
+            except Exception as e:
+                print('=== Error loading file %s: %s' % (filestr, e))
+                frames += [None]
+                continue
+            data = {}
+            for key, values in columns:
+                data[key] = _attach_shared(*values) if isinstance(values, tuple) else values
+            frame = pd.DataFrame(data, columns = [key for key, values in columns], copy = False)
+            frame.attrs['scan'] = scan
+            frames += [frame]
+    return frames
+
+
+def define(name, expr):
+    '''
+    define named derived column for use with derive, e.g.
+    define('norm', 'sum/ic1monitor')
+    define('apd_rate', '(apd - bg)/count_time')
+    definitions can use columns and other definitions
+    '''
+    _derived_columns[name] = expr
+
+
+def _compile_expression(expr):
+    'return (code, names used) for expression - compiled once and cached'
+    if expr not in _compiled_expressions:
+        code = compile(expr, '<derived column>', 'eval')
+        _compiled_expressions[expr] = (code, code.co_names)
+    return _compiled_expressions[expr]
+
+
+def _numexpr_expression(expr, names):
+    '''
+    expression with column names replaced by aliases (_col0, _col1...) so that columns named like numexpr
+    functions (e.g. sum) are not taken as functions - returns (expression, {alias: column name})
+    '''
+    key = (expr, names)
+    if key not in _numexpr_expressions:
+        aliases = dict((nm, '_col%i' % i) for i, nm in enumerate(names))
+        tokens = [(tok.type, aliases.get(tok.string, tok.string) if tok.type == tokenize.NAME else tok.string)
+                  for tok in tokenize.generate_tokens(io.StringIO(expr).readline)]
+        _numexpr_expressions[key] = (tokenize.untokenize(tokens).strip(), dict((alias, nm) for nm, alias in aliases.items()))
+    return _numexpr_expressions[key]
+
+
+def _evaluate(frame, expr):
+    'values of expression or named definition over columns of frame (definitions used are evaluated, not added to frame)'
+    expr = _derived_columns.get(expr, expr)
+    code, names = _compile_expression(expr)
+    cols = {}
+    for nm in names:
+        if nm in frame.columns:
+            cols[nm] = frame[nm].values
+        elif nm in _derived_columns:
+            cols[nm] = _evaluate(frame, nm)    # dependency on another definition
+    if numexpr is not None and not expr in _numexpr_unsupported:
+        try:
+            nexpr, aliases = _numexpr_expression(expr, tuple(cols))
+            return numexpr.evaluate(nexpr, local_dict = dict((alias, cols[nm]) for alias, nm in aliases.items()))   # numexpr caches compiled expression
+        except:
+            _numexpr_unsupported.add(expr)      # e.g. numpy functions - use numpy
+    return eval(code, _numpy_namespace, cols)
+
+
+def derive(frame, expr, name = None):
+    '''
+    derive(frame, expr, name = None)
+    evaluate expression (e.g. 'sum/ic1monitor') or named definition (see define) over columns of frame
+    and add result as column name (defaults to definition name or expression string)
+    frame can be a pdnx or any DataFrame, e.g. pd.concat of many scans - evaluated in one pass
+    uses numexpr if available (no intermediate temporaries), otherwise numpy
+    other definitions used by the expression are evaluated but not added to frame
+    returns the derived column values
+    '''
+    if name == None:
+        name = expr
+    values = _evaluate(frame, expr)
+    frame[name] = values
+    return values
+
+
+def decimate(x, y, nbins):
+    '''
+    xd, yd = decimate(x, y, nbins)
+    min/max decimation: split data into nbins (e.g. axis width in pixels) and keep the
+    minimum and maximum y point in each bin, so peaks are preserved in a plot of at most 2*nbins points
+    points are kept in their original (acquisition) order
+    '''
+    x = np.asarray(x); y = np.asarray(y)
+    npts = len(y)
+    nbins = max(int(nbins), 1)
+    if npts <= 2 * nbins:
+        return x, y
+    per_bin = npts // nbins
+    nfull = per_bin * nbins
+    ybins = y[:nfull].reshape(nbins, per_bin)
+    offsets = np.arange(nbins) * per_bin
+    ind = np.concatenate((ybins.argmin(axis = 1) + offsets, ybins.argmax(axis = 1) + offsets, np.arange(nfull, npts), [0, npts - 1]))
+    ind = np.unique(ind)    # sorted and without duplicates
+    return x[ind], y[ind]
+
+
+def resample(scans, x, y, grid, method = 'linear'):
+    '''
+    resample(scans, x, y, grid, method = 'linear')
+    interpolate y(x) from many scans onto common x grid - returns 2D array (scan, grid point)
+    scans: list of pdnx/DataFrames (x, y are column names) or list of (xdata, ydata) pairs (x, y ignored)
+    method = 'linear': linear interpolation (NaN outside the x range of each scan)
+    method = 'bin': average of points falling in bins centred on grid points (NaN for empty bins)
+    scans can have different lengths and need not be monotonic in x (points are sorted)
+    points with NaN x are ignored; NaN y values give NaN at the neighbouring grid points (as np.interp)
+    e.g. mat = resample([pdnx(p % i) for i in scan_numbers], 'DCMenergy', 'sum', np.linspace(8.06, 8.12, 200))
+    '''
+    xlist, ylist = [], []
+    for scan in scans:
+        if isinstance(scan, pd.DataFrame):
+            xlist += [np.asarray(scan[x], dtype = float)]; ylist += [np.asarray(scan[y], dtype = float)]
+        else:
+            xlist += [np.asarray(scan[0], dtype = float)]; ylist += [np.asarray(scan[1], dtype = float)]
+    grid = np.asarray(grid, dtype = float)
+    nscans, ngrid = len(xlist), len(grid)
+    if method == 'bin':
+        return _resample_bin(xlist, ylist, grid)
+    if method != 'linear':
+        raise ValueError("=== method must be 'linear' or 'bin'")
+
+    # np.interp (C) for each scan, with cleaning and sorting only for scans that need it and the grid range
+    # found by bisection (slices, no masks) - faster than fully vectorised interpolation, which needs several
+    # temporaries of size nscans*ngrid (see bench_resample.py)
+    result = np.full((nscans, ngrid), np.nan)
+    gridlist = grid.tolist() if np.all(grid[1:] >= grid[:-1]) else None    # bisect on list: fast for scalars
+    for iscan in range(nscans):
+        xd, yd = xlist[iscan], ylist[iscan]
+        if len(xd) < 2:
+            continue
+        if xd[0] > xd[-1]:      # scan in decreasing x
+            xd, yd = xd[::-1], yd[::-1]
+        if not np.all(xd[1:] >= xd[:-1]):       # not sorted or NaN in x
+            ok = np.isfinite(xd)
+            order = np.argsort(xd[ok], kind = 'stable')
+            xd, yd = xd[ok][order], yd[ok][order]
+            if len(xd) < 2:
+                continue
+        if gridlist is not None:
+            lo, hi = bisect.bisect_left(gridlist, xd[0]), bisect.bisect_right(gridlist, xd[-1])
+            result[iscan, lo:hi] = np.interp(grid[lo:hi], xd, yd)
+        else:
+            inside = (grid >= xd[0]) & (grid <= xd[-1])
+            result[iscan, inside] = np.interp(grid[inside], xd, yd)
+    return result
+
+
+def _resample_bin(xlist, ylist, grid):
+    'resample method bin: points from all scans are binned in one vectorised pass (grid in any order)'
+    nscans, ngrid = len(xlist), len(grid)
+    if ngrid < 2:
+        raise ValueError('=== Binning needs at least two grid points')
+    if nscans == 0:
+        return np.zeros((0, ngrid))
+    if np.any(grid[1:] < grid[:-1]):     # e.g. decreasing grid: bin on sorted grid and return in grid order
+        order = np.argsort(grid, kind = 'stable')
+        result = np.empty((nscans, ngrid))
+        result[:, order] = _resample_bin(xlist, ylist, grid[order])
+        return result
+    ids = np.repeat(np.arange(nscans), [len(xd) for xd in xlist])
+    xall, yall = np.concatenate(xlist), np.concatenate(ylist)
+    edges = np.concatenate(([1.5*grid[0] - 0.5*grid[1]], (grid[1:] + grid[:-1])/2, [1.5*grid[-1] - 0.5*grid[-2]]))
+    ibin = np.searchsorted(edges, xall) - 1
+    ok = (ibin >= 0) & (ibin < ngrid) & np.isfinite(yall)
+    flat = ids[ok]*ngrid + ibin[ok]
+    sums = np.bincount(flat, weights = yall[ok], minlength = nscans*ngrid)
+    counts = np.bincount(flat, minlength = nscans*ngrid)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        return (sums/counts).reshape(nscans, ngrid)
+
+
 def vec2mat(vecx, vecy, vecz, n_inner=None):
     #matx, maty, matz = vec2mat(vecx, vecy, vecz, n_inner=None)
     #convert vectors from 2D scan to matrices
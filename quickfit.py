@@ -1,6 +1,17 @@
-from __main__ import gca, plot, axis, xlim
+try:
+    from __main__ import gca, plot, axis, xlim
+except ImportError:     # not in interactive pylab session (e.g. script or worker process)
+    from matplotlib.pyplot import gca, plot, axis, xlim
 from lmfit import Model
+from lmfit.model import ModelResult
+from collections import OrderedDict
 import numpy as np
+import hashlib
+import os
+
+fit_cache_size = 128    # number of fit results kept in memory by fit (0 for no caching)
+fit_cache_dir = None    # directory for saving fit results on disk as well (None for memory only)
+_fit_cache = OrderedDict()
 
 def peak(xdat, ydat, nbgpts=1):
     '''
@@ -26,6 +37,109 @@ def peak(xdat, ydat, nbgpts=1):
     fwhm_area = area/height * 0.3989 * np.sqrt(8*np.log(2))
     return [centre, fwhm_sd, fwhm_area, sumdat, height, area, m, c]    
  
+def _fill_nonfinite(a):
+    'copy of 2D array (points x columns) with NaN/inf replaced by the previous finite value in each column (next at start)'
+    ok = np.isfinite(a)
+    if ok.all():
+        return a
+    rows, cols = np.arange(len(a))[:, np.newaxis], np.arange(a.shape[1])
+    previous = np.maximum.accumulate(np.where(ok, rows, 0), axis = 0)
+    following = np.minimum.accumulate(np.where(ok, rows, len(a) - 1)[::-1], axis = 0)[::-1]
+    return a[np.where(ok[previous, cols], previous, following), cols]
+
+
+def _column_features(xdat, ydat, nbgpts = 1, snr = 5):
+    '''
+    vectorised peak/edge detection for each column of 2D array ydat (points x columns)
+    xdat is 1D (same x for all columns) or 2D like ydat
+    returns list of dicts (column index, type, position, height, width, snr) for detected features
+    peaks use the same linear background and moments as peak
+    edges are localised, mostly monotonic steps between the ends of the scan
+    NaN points are filled from their neighbours so a bad point does not hide a feature
+    '''
+    y = np.asarray(ydat, dtype = float)
+    x = np.asarray(xdat, dtype = float)
+    if x.ndim == 1:
+        x = np.broadcast_to(x[:, np.newaxis], y.shape)
+    y, x = _fill_nonfinite(y), _fill_nonfinite(x)
+    npts = len(x)
+    if npts < 2*nbgpts + 3:
+        return []
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        m = (y[-nbgpts:].mean(0) - y[:nbgpts].mean(0))/(x[-nbgpts:].mean(0) - x[:nbgpts].mean(0))  # linear b/g as peak
+        c = y[:nbgpts].mean(0) - x[:nbgpts].mean(0)*m
+        yc = y - x*m - c
+        sumdat = yc.sum(0)
+        height = yc.max(0)
+        centre = (x*yc).sum(0)/sumdat
+        xspan = x[-1] - x[0]
+        fwhm = sumdat*np.abs(xspan)/npts/height * 0.3989 * np.sqrt(8*np.log(2))  # fwhm_area from peak (x either direction)
+        noise = np.median(np.abs(np.diff(y, axis = 0)), axis = 0)/0.6745/np.sqrt(2)  # robust point-to-point noise
+        nend = max(nbgpts, npts//10)
+        step = y[-nend:].mean(0) - y[:nend].mean(0)
+        win = max(1, npts//20)
+        ycum = np.cumsum(y, axis = 0)
+        monotonic = np.abs(step)/np.abs(np.diff((ycum[win:] - ycum[:-win])/win, axis = 0)).sum(0) # ~1 for step, ~0 for peak
+        slope = (y[win:] - y[:-win])/(x[win:] - x[:-win])
+        islope = np.argmax(np.abs(np.nan_to_num(slope)), axis = 0)
+        icols = np.arange(y.shape[1])
+        maxslope = slope[islope, icols]
+        edgewidth = np.abs(step/maxslope)
+        snr_peak, snr_edge = height/noise, np.abs(step)/noise
+        is_edge = (snr_edge >= snr) & (monotonic > 0.5) & (edgewidth < 0.25*np.abs(xspan))    # not a ramp
+        is_peak = ~is_edge & (snr_peak >= snr) & np.isfinite(centre) & (fwhm > 0)
+    features = []
+    for icol in np.nonzero(is_peak)[0]:
+        features += [{'column': icol, 'type': 'peak', 'position': centre[icol], 'height': height[icol], 'width': fwhm[icol], 'snr': snr_peak[icol]}]
+    for icol in np.nonzero(is_edge)[0]:
+        i = islope[icol]
+        features += [{'column': icol, 'type': 'edge', 'position': (x[i, icol] + x[i + win, icol])/2, 'height': step[icol],
+                      'width': edgewidth[icol], 'snr': snr_edge[icol]}]
+    return features
+
+
+def features(frame, x = None, snr = 5, nbgpts = 1):
+    '''
+    table = features(frame, x = None, snr = 5, nbgpts = 1)
+    detect peaks and edges in every numeric column of a scan DataFrame (e.g. pdnx) against column x
+    (default: first column) - all columns are analysed together with NumPy
+    frame can also hold many scans with the scan in the first index level, e.g. pd.concat(scans, keys = files)
+    or loadentries(file, concat = True); scans of equal length are all analysed together
+    returns DataFrame with scan (batches only), column, type ('peak' or 'edge'), position, height, width, snr
+    peak position, height and width (fwhm) are from the same linear background and moments as peak
+    edge height is the step and width is step/(maximum slope)
+    snr is height/noise where noise is estimated from point-to-point differences
+    e.g. features(pd.concat(load_parallel(files), keys = files))
+    '''
+    import pandas as pd
+    columns = ['column', 'type', 'position', 'height', 'width', 'snr']
+    xkey = frame.columns[0] if x is None else x
+    ycols = [col for col in frame.columns if col != xkey and np.issubdtype(frame[col].dtype, np.number)]
+    if not isinstance(frame.index, pd.MultiIndex):
+        rows = _column_features(frame[xkey].values, frame[ycols].values, nbgpts, snr)
+        for row in rows:
+            row['column'] = ycols[row['column']]
+        return pd.DataFrame(rows, columns = columns)
+
+    scans = frame.index.get_level_values(0)
+    codes, names = pd.factorize(scans)
+    lengths = np.bincount(codes)
+    rows = []
+    if np.all(lengths == lengths[0]) and np.all(np.diff(codes) >= 0):  # equal length, contiguous: one 2D array
+        npts, nscans, ncols = lengths[0], len(names), len(ycols)
+        ydat = frame[ycols].values.reshape(nscans, npts, ncols).transpose(1, 0, 2).reshape(npts, nscans*ncols)
+        xdat = np.repeat(frame[xkey].values.reshape(nscans, npts).T, ncols, axis = 1)
+        for row in _column_features(xdat, ydat, nbgpts, snr):
+            row['scan'], row['column'] = names[row['column']//ncols], ycols[row['column'] % ncols]
+            rows += [row]
+    else:
+        for iscan, (scan, scandata) in enumerate(frame.groupby(level = 0, sort = False)):
+            for row in _column_features(scandata[xkey].values, scandata[ycols].values, nbgpts, snr):
+                row['scan'], row['column'] = scan, ycols[row['column']]
+                rows += [row]
+    return pd.DataFrame(rows, columns = ['scan'] + columns)
+
+
 ### some pre-defined peak and background functions
 
 def gauss(x, area, cen, fwhm):
@@ -52,6 +166,58 @@ pv_lin = Model(pvoigt) + Model(poly2)
 
 
 
+def _fit_key(func, xData, yData, params):
+    'hash of data, model and initial/fixed parameters'
+    key = hashlib.sha1()
+    key.update(np.ascontiguousarray(xData, dtype = float).tobytes())
+    key.update(np.ascontiguousarray(yData, dtype = float).tobytes())
+    key.update(func.name.encode())
+    key.update(params.dumps(sort_keys = True).encode())
+    return key.hexdigest()
+
+
+def cached_fit(func, xData, yData, params, cache = True):
+    '''
+    result = cached_fit(func, xData, yData, params)
+    lmfit fit of func to data, returning the previous result if the same data, model and
+    starting parameters (values, fixed/varied, bounds) have been fitted before
+    fit_cache_size results are kept in memory (least recently used removed first)
+    set fit_cache_dir (quickfit.fit_cache_dir = '/path') to also save results on disk for later sessions
+    '''
+    if not cache or fit_cache_size <= 0:
+        return func.fit(yData, x = xData, params = params)
+    key = _fit_key(func, xData, yData, params)
+    if key in _fit_cache:
+        _fit_cache.move_to_end(key)
+        return _fit_cache[key]
+
+    result = None
+    filename = os.path.join(fit_cache_dir, key + '.json') if fit_cache_dir else None
+    if filename and os.path.exists(filename):
+        try:
+            funcdefs = dict((model.func.__name__, model.func) for model in func.components)
+            with open(filename) as f:
+                result = ModelResult(func, params).loads(f.read(), funcdefs = funcdefs)
+        except:
+            result = None
+    if result is None:
+        result = func.fit(yData, x = xData, params = params)
+        if filename:
+            try:
+                os.makedirs(fit_cache_dir, exist_ok = True)
+                tmpfile = filename + '.tmp%i' % os.getpid()   # processes sharing fit_cache_dir write own file
+                with open(tmpfile, 'w') as f:
+                    f.write(result.dumps())
+                os.replace(tmpfile, filename)
+            except:
+                print('=== Could not save fit result in %s' % fit_cache_dir)
+
+    _fit_cache[key] = result
+    while len(_fit_cache) > fit_cache_size:
+        _fit_cache.popitem(last = False)
+    return result
+
+
 class fit():
     '''
     create fit instance (i.e. do a fit) from peak-like plot data
@@ -69,9 +235,11 @@ class fit():
       ff.result                           # show full result (rich display in ipython)
       ff.params                           # return lmfit parameters (rich display in ipython
       pv_c.fit(y, pin, x=x)               # fit directly using lmfit model
+    results are cached (see cached_fit) so refitting unchanged data with the same model and parameters is instant
+      ff = fit(pv_c, cache = False)       # always redo the fit
     '''
     
-    def __init__(self, func, aXis = None, params = None):
+    def __init__(self, func, aXis = None, params = None, cache = True):
 
         if aXis == None:
             aXis = gca()
@@ -96,7 +264,7 @@ class fit():
           # use parameters supplied (params) if given
           self.params = params
 
-        self.result =  func.fit(yData, x=xData, params = self.params)   #do the fit 
+        self.result =  cached_fit(func, xData, yData, self.params, cache)   #do the fit (or reuse previous result)
 
         outstr = func.name+'\n\n'
         for pname in self.result.params:
@@ -115,3 +283,152 @@ class fit():
     
         plot(xData, func.eval(x=xData, params=self.result.params),'r.'); axis('tight'); xlim(xL, xU);
 
+
+
+class livefit():
+    '''
+    incremental peak tracking while a scan is acquiring
+    peak moments are updated from running sums (constant time per point) and an lmfit refit
+    (warm-started from the previous result) is done only when enough new points have arrived
+    example:
+      lf = livefit(pv_c)                  # lmfit model for refits (livefit() for moments only)
+      lf.add(x, y)                        # add point or arrays of points, e.g. from a scan callback
+      lf.follow(filename, '/entry1/measurement/eta', '/entry1/measurement/sum')  # or read new points from growing file
+      lf.peak()                           # [centre, fwhm_sd, fwhm_area, sum, height, area, m, c] as from peak function
+      lf.result                           # latest lmfit result (None until first refit)
+    refits start from the previous result unless its centre or fwhm are outside the data (e.g. early in scan)
+    height is taken at the maximum y point, so is approximate if the background changes during the scan
+    '''
+
+    def __init__(self, func = None, nbgpts = 1, refit_points = 10, refit_fraction = 0.2):
+        '''
+        func: lmfit model (e.g. pv_c) or None for moments only
+        nbgpts: number of points at each end used for linear background (as peak)
+        refit when at least refit_points new points and refit_fraction of points in previous fit have arrived
+        '''
+        self.func = func
+        self.nbgpts = nbgpts
+        self.refit_points = refit_points
+        self.refit_fraction = refit_fraction
+        self.result = None
+        self.params = None
+        self.npts = 0
+        self._nfit = 0
+        self._nread = 0         # rows of file datasets read by follow (non-finite points are not added)
+        self._x = np.zeros(256); self._y = np.zeros(256)
+        self._sums = np.zeros(7)        # n, x, x^2, x^3, y, xy, x^2y with x relative to first point
+        self._x0 = None
+        self._ymax, self._xmax = -np.inf, 0
+
+    @property
+    def x(self):
+        return self._x[:self.npts]
+
+    @property
+    def y(self):
+        return self._y[:self.npts]
+
+    def add(self, xData, yData):
+        'add new point(s) - updates running sums and refits if enough new points'
+        xData = np.atleast_1d(np.asarray(xData, dtype = float)); yData = np.atleast_1d(np.asarray(yData, dtype = float))
+        ok = np.isfinite(xData) & np.isfinite(yData)
+        xData, yData = xData[ok], yData[ok]
+        if len(xData) == 0:
+            return
+        if self._x0 is None:
+            self._x0 = xData[0]
+        while self.npts + len(xData) > len(self._x):    # grow buffers by doubling
+            self._x = np.concatenate((self._x, np.zeros(len(self._x)))); self._y = np.concatenate((self._y, np.zeros(len(self._y))))
+        self._x[self.npts:self.npts + len(xData)] = xData
+        self._y[self.npts:self.npts + len(yData)] = yData
+        self.npts += len(xData)
+        dx = xData - self._x0
+        self._sums += [len(dx), dx.sum(), (dx**2).sum(), (dx**3).sum(), yData.sum(), (dx*yData).sum(), (dx**2*yData).sum()]
+        imax = yData.argmax()
+        if yData[imax] > self._ymax:
+            self._ymax, self._xmax = yData[imax], xData[imax]
+        if self.func is not None and self.npts - self._nfit >= max(self.refit_points, self.refit_fraction*self._nfit):
+            self.refit()
+
+    def peak(self):
+        '''
+        [centre, fwhm_sd, fwhm_area, sum, height, area, m, c] from running sums - same as peak(x, y, nbgpts)
+        except height (see class doc)
+        '''
+        nb = min(self.nbgpts, self.npts)
+        x, y = self.x, self.y
+        m = (np.mean(y[self.npts - nb:]) - np.mean(y[:nb]))/(np.mean(x[self.npts - nb:]) - np.mean(x[:nb]))
+        c = np.mean(y[:nb]) - (np.mean(x[:nb]) - self._x0)*m    # intercept relative to first x
+        n, sx, sxx, sxxx, sy, sxy, sxxy = self._sums
+        sumdat = sy - m*sx - c*n                                    # sums after background subtraction
+        s1 = sxy - m*sxx - c*sx
+        s2 = sxxy - m*sxxx - c*sxx
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):   # NaN/inf until peak is in the data
+            cen = s1/sumdat
+            area = sumdat*(x[-1] - x[0])/n
+            height = self._ymax - m*(self._xmax - self._x0) - c
+            fwhm_sd = np.sqrt((s2 - 2*cen*s1 + cen**2*sumdat)/sumdat) * np.sqrt(8*np.log(2))
+            fwhm_area = area/height * 0.3989 * np.sqrt(8*np.log(2))
+        return [cen + self._x0, fwhm_sd, fwhm_area, sumdat, height, area, m, c - m*self._x0]
+
+    def _usable(self, result):
+        'True if result can be used as starting point (centre and fwhm, if fitted, within range of data)'
+        if result is None or not result.success:
+            return False
+        xmin, xmax = self.x.min(), self.x.max()
+        prms = result.params
+        if 'cen' in prms and not xmin <= prms['cen'].value <= xmax:
+            return False
+        if 'fwhm' in prms and not 0 < prms['fwhm'].value <= xmax - xmin:
+            return False
+        return True
+
+    def refit(self):
+        'lmfit fit of all points so far, starting from previous result if usable, otherwise from peak values'
+        if self.npts < 2*self.nbgpts + 1:
+            return
+        if not self._usable(self.result):
+            pk_prms = {}
+            [pk_prms['cen'], fwhm_sd, pk_prms['fwhm'], pk_prms['sum'], pk_prms['amp'], pk_prms['area'], pk_prms['m'], pk_prms['c']] = self.peak()
+            if not (np.isfinite(pk_prms['cen']) and np.isfinite(pk_prms['fwhm'])):
+                return      # no peak in data yet
+            params = self.func.make_params()
+            for key in params.keys():
+                params[key].value = pk_prms.get(key, 0)
+        else:
+            params = self.result.params
+        try:
+            self.result = self.func.fit(self.y, x = self.x, params = params)
+            self.params = self.result.params
+        except Exception as e:
+            print('=== livefit: fit failed with %i points: %s' % (self.npts, e))
+        self._nfit = self.npts
+
+    def follow(self, filename, xpath, ypath, interval = 0.5, timeout = 10, callback = None):
+        '''
+        read new points from datasets xpath and ypath in nexus/hdf5 file while it is being written
+        file is polled every interval seconds; stops when no new points for timeout seconds
+        callback(self) is called after each batch of new points (e.g. to print or plot the current peak)
+        trailing NaN rows (e.g. pre-allocated datasets) are read again on the next poll, NaN rows followed
+        by data are skipped
+        '''
+        import h5py
+        import time
+        tlast = time.time()
+        while time.time() - tlast < timeout:
+            try:
+                with h5py.File(filename, 'r', swmr = True) as f:
+                    nrows = min(len(f[xpath]), len(f[ypath]))
+                    if nrows > self._nread:
+                        xData, yData = f[xpath][self._nread:nrows], f[ypath][self._nread:nrows]
+                        ok = np.nonzero(np.isfinite(xData) & np.isfinite(yData))[0]
+                        if len(ok) > 0:
+                            self.add(xData[:ok[-1] + 1], yData[:ok[-1] + 1])
+                            self._nread += ok[-1] + 1
+                            tlast = time.time()
+                            if callback is not None:
+                                callback(self)
+            except (IOError, OSError, KeyError):
+                pass    # file or datasets not written yet
+            time.sleep(interval)
+        return self